@@ -1,8 +1,36 @@
-import torch, operator
+import torch
 import torch.nn.functional as F
-from itertools import groupby
-from queue import PriorityQueue
-from collections import namedtuple
+from .model import prepare_decoder
+
+
+
+def greedy_decode(decoder, encoder, x, bos_id, eos_id, pad_id, max_len, check_steps):
+    batch_size = x.size(0)
+    hiddens = encoder(x)
+
+    pred = torch.full(
+        (batch_size, max_len), pad_id, 
+        dtype=torch.long, device=x.device
+    )
+    pred[:, 0] = bos_id
+
+    pred_token = torch.full(
+        (batch_size,), bos_id, 
+        dtype=torch.long, device=x.device
+    )
+    finished = torch.zeros_like(pred_token, dtype=torch.bool)
+
+    for t in range(1, max_len):
+        out, hiddens = decoder(pred_token, hiddens)
+        pred_token = out.argmax(-1).masked_fill(finished, pad_id)
+        pred[:, t] = pred_token
+
+        #Only sync with the host every few steps to check termination
+        finished |= pred_token == eos_id
+        if not t % check_steps and finished.all():
+            break
+
+    return pred
 
 
 
@@ -14,18 +42,22 @@ class Generator:
         self.tokenizer = tokenizer
         self.device = config.device
         self.model_type = config.model_type
+        self.search_method = config.search_method
         
         self.max_len = 512
         self.beam_size = 4
+        self.decoder = prepare_decoder(model, self.device, [1, self.beam_size])
+        self.check_steps = 8
+
+        #Length penalties for every reachable length, looked up when scoring beams
+        min_length, alpha = 5, 1.2
+        lengths = torch.arange(self.max_len, device=self.device)
+        self.len_penalty = ((lengths + min_length) / (1 + min_length)).pow(alpha)
 
         self.bos_id = config.bos_id
         self.eos_id = config.eos_id
         self.pad_id = config.pad_id
 
-        self.Node = namedtuple(
-            'Node', ['prev_node', 'pred', 'log_prob', 'hiddens', 'length']
-            )
-
 
     def inference(self):
         print(f'--- Inference Process Started! ---')
@@ -43,157 +75,130 @@ class Generator:
             print(f"Model Out Sequence >> {output_seq}")      
 
 
-    def generate(self, input_seq, search_method):
-        
-        input_tensor = self.tokenizer.encode(input_tensor).ids    
-        input_tensor = torch.LongTensor([input_tensor]).to(self.device)
+    def generate(self, input_seq):
+        input_ids = self.tokenizer.encode(input_seq).ids
+        input_tensor = torch.as_tensor(input_ids, dtype=torch.long).unsqueeze(0)
+
+        #Pinned host memory lets the copy to the GPU run asynchronously
+        if self.device.type == 'cuda':
+            input_tensor = input_tensor.pin_memory()
+        input_tensor = input_tensor.to(self.device, non_blocking=True)
 
-        with torch.no_grad():
+        with torch.inference_mode():
             if self.search_method == 'greedy':
                 generated_ids = self.greedy_search(input_tensor)
             elif self.search_method == 'beam':
                 generated_ids = self.beam_search(input_tensor)
         
-        return self.tokenizer.decode(generated_ids)
+        return self.tokenizer.decode(generated_ids[0])
 
 
 
-    def get_score(self, node, max_repeat=5, min_length=5, alpha=1.2): 
-        if not node.log_prob:
-            return node.log_prob
-
+    def get_score(self, preds, log_probs, lengths, max_repeat=5): 
         #find max number of consecutively repeated tokens
-        repeat = max([sum(1 for token in group if token != self.pad_id) \
-                     for _, group in groupby(node.pred.tolist())])
+        is_pad = preds == self.pad_id
+        same = torch.zeros_like(is_pad)
+        same[:, 1:] = (preds[:, 1:] == preds[:, :-1]) & ~is_pad[:, 1:]
+
+        positions = torch.arange(preds.size(1), device=preds.device).expand_as(preds)
+        run_start = positions.masked_fill(same, 0).cummax(dim=-1).values
+        run_length = (positions - run_start + 1).masked_fill(is_pad, 0)
+        repeat = run_length.max(dim=-1).values
 
-        repeat_penalty = 0.5 if repeat > max_repeat else 1
-        len_penalty = ((node.length + min_length) / (1 + min_length)) ** alpha
+        repeat_penalty = torch.where(repeat > max_repeat, 0.5, 1.0)
+        len_penalty = self.len_penalty.index_select(0, lengths)
         
-        score = node.log_prob / len_penalty
-        score = score * repeat_penalty
+        #log_probs are negative: len_penalty >= 1 raises the score to favour longer beams,
+        #while the 0.5 repeat_penalty doubles its magnitude and lowers it
+        score = log_probs / (len_penalty * repeat_penalty)
 
         return score
 
 
-    def init_nodes(self, hiddens):
-        Node = self.Node
-        nodes = PriorityQueue()
-        bos_tokens = torch.LongTensor(1, 1).fill_(self.bos_id).to(self.device)
-
-        start_node = Node(
-            prev_node = None, 
-            pred = bos_tokens, 
-            log_prob = 0.0, 
-            hiddens = hiddens,                               
-            length = 0
-        )
-
-        for _ in range(self.beam_size):
-            nodes.put((0, start_node))        
-
-        return Node, nodes, []
+    def select_hiddens(self, hiddens, indices, out=None):
+        if self.model_type == 'lstm':
+            out = out or (None, None)
+            return tuple(torch.index_select(h, 1, indices, out=o) for h, o in zip(hiddens, out))
+        return torch.index_select(hiddens, 1, indices, out=out)
 
 
 
     def beam_search(self, input_tensor):
-        batch_pred = []
         batch_size = input_tensor.size(0)
-        batch_hiddens = self.model.encoder(input_tensor)
+        beam_size = self.beam_size
+        hiddens = self.model.encoder(input_tensor)
 
-        for idx in range(batch_size):
-            
-            if self.model_type == 'lstm':
-                hiddens = (
-                    batch_hiddens[0][:, idx].unsqueeze(1).contiguous(), 
-                    batch_hiddens[1][:, idx].unsqueeze(1).contiguous()
-                )
-            else:
-                hiddens = batch_hiddens[:, idx].unsqueeze(1).contiguous()
-
-            Node, nodes, end_nodes = self.get_nodes(hiddens)
-            
-            for t in range(self.max_len):
-                curr_nodes = []
-                while True:
-                    try:
-                        curr_node = nodes.get()
-                        curr_nodes.append(curr_node)
-                    except:
-                        continue
-                    if len(curr_nodes) == self.beam_size:
-                        break                    
-                
-                for curr_score, curr_node in curr_nodes:
-                    last_token = curr_node.pred[:, -1]
-
-                    if last_token.item() == self.eos_id:
-                        end_nodes.append((curr_score, curr_node))
-                        continue
-
-                    out, hidden = self.model.decoder(last_token, curr_node.hiddens)                
-                    logits, preds = torch.topk(out, self.beam_size)
-                    log_probs = -F.log_softmax(logits, dim=-1)
-
-                    for k in range(self.beam_size):
-                        pred = preds[:, k].unsqueeze(0)
-                        log_prob = log_probs[:, k].item()
-                        pred = torch.cat([curr_node.pred, pred], dim=-1)
-                        
-                        next_node = Node(
-                            prev_node = curr_node,
-                            pred = pred,
-                            log_prob = curr_node.log_prob + log_prob,
-                            hiddens = hidden,
-                            length = curr_node.length+1
-                        )
-
-                        next_score = self.get_score(next_node)                        
-                        try:
-                            nodes.put((next_score, next_node))
-                        except:
-                            continue                            
-
-                    if not t:
-                        break
-
-            if len(end_nodes) == 0:
-                _, top_node = nodes.get()
-            else:
-                _, top_node = sorted(
-                    end_nodes, 
-                    key=operator.itemgetter(0), 
-                    reverse=True
-                )[0]
+        #Every beam of a sentence starts from the same state, so the first step runs once per sentence
+        bos_tokens = torch.full(
+            (batch_size,), self.bos_id, 
+            dtype=torch.long, device=self.device
+        )
+        out, hiddens = self.decoder(bos_tokens, hiddens)
+        log_probs, tokens = F.log_softmax(out, dim=-1, dtype=torch.float).topk(beam_size, dim=-1)
+        log_probs, tokens = log_probs.view(-1), tokens.view(-1)
+
+        #Copy each sentence hiddens to its beams -> (n_layers, batch_size * beam_size, hidden_dim)
+        beam_idx = torch.arange(batch_size, device=self.device)
+        hiddens = self.select_hiddens(hiddens, beam_idx.repeat_interleave(beam_size))
+        beam_offset = beam_idx.unsqueeze(1) * beam_size
+
+        #Parent hiddens are gathered into these two buffers in turn, instead of fresh tensors every step
+        if self.model_type == 'lstm':
+            hid_bufs = [hiddens, tuple(torch.empty_like(h) for h in hiddens)]
+        else:
+            hid_bufs = [hiddens, torch.empty_like(hiddens)]
+
+        preds = torch.full(
+            (batch_size * beam_size, self.max_len), self.pad_id, 
+            dtype=torch.long, device=self.device
+        )
+        preds[:, 0] = self.bos_id
+        preds[:, 1] = tokens
+        lengths = torch.ones_like(tokens)
+        finished = tokens == self.eos_id
+
+        #Finished beams can only be extended with pad, which keeps their scores
+        vocab_size = out.size(-1)
+        pad_logp = torch.full((vocab_size,), float('-inf'), device=self.device)
+        pad_logp[self.pad_id] = 0.0
+        
+        for t in range(2, self.max_len):
+            out, hiddens = self.decoder(tokens, hiddens)
+            logp = F.log_softmax(out, dim=-1, dtype=torch.float)
+            logp = torch.where(finished.unsqueeze(1), pad_logp, logp)
+
+            log_probs, top_idx = logp.view(batch_size, beam_size, vocab_size) \
+                                     .add_(log_probs.view(batch_size, beam_size, 1)) \
+                                     .view(batch_size, -1) \
+                                     .topk(beam_size, dim=-1)
             
-            pred = top_node.pred.squeeze()[1:]
-            batch_pred.append(pred.tolist())
-
-        return self.tokenizer.decode(batch_pred)
+            parent_idx = (top_idx // vocab_size + beam_offset).view(-1)
+            tokens = (top_idx % vocab_size).view(-1)
+            log_probs = log_probs.view(-1)
+
+            hiddens = self.select_hiddens(hiddens, parent_idx, out=hid_bufs[(t - 1) % 2])
+            #Only the generated prefix is gathered, the pad tail stays in place
+            preds[:, :t] = preds[parent_idx, :t]
+            preds[:, t] = tokens
+
+            #Only beams that were still live have grown by one token
+            finished = finished.index_select(0, parent_idx)
+            lengths = lengths.index_select(0, parent_idx) + (~finished).long()
+            finished = finished | (tokens == self.eos_id)
+
+            #Only sync with the host every few steps to check termination
+            if not t % self.check_steps and finished.all():
+                break
+
+        scores = self.get_score(preds, log_probs, lengths).view(batch_size, beam_size)
+        top_beam = scores.topk(1, dim=-1).indices + beam_offset
+        return preds.index_select(0, top_beam.view(-1))[:, 1:].tolist()
     
 
     def greedy_search(self, input_tensor):
-        batch_pred = []
-        batch_size = input_tensor.size(0)
-        batch_hiddens = self.model.encoder(input_tensor)
-
-        for idx in range(batch_size):
-            
-            hiddens = (
-                batch_hiddens[0][:, idx].unsqueeze(1).contiguous(), 
-                batch_hiddens[1][:, idx].unsqueeze(1).contiguous()
-            )
-            
-            dec_input = torch.LongTensor(1).fill_(self.bos_id).to(self.device)
-            pred = torch.LongTensor(self.max_len).fill_(self.pad_id).to(self.device)
-
-            for t in range(1, self.max_len):
-                out, hiddens = self.model.decoder(dec_input, hiddens)
-                pred_token = out.argmax(-1)
-                pred[t] = pred_token
-                dec_input = pred_token
-
-                if pred_token.item() == self.eos_id:
-                    break
-            batch_pred.append(pred[1:].tolist())
-
-        return self.tokenizer.decode(batch_pred)
\ No newline at end of file
+        pred = greedy_decode(
+            self.decoder, self.model.encoder, input_tensor, 
+            self.bos_id, self.eos_id, self.pad_id, 
+            self.max_len, self.check_steps
+        )
+        return pred[:, 1:].tolist()
\ No newline at end of file
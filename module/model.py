@@ -47,4 +47,45 @@ def load_model(config):
         print(f"Model states has loaded from {config.ckpt}")       
     
     print_model_desc(model)
-    return model.to(config.device)
\ No newline at end of file
+    model = model.to(config.device)
+
+    #Half precision halves the memory traffic of the recurrent matmuls at evaluation
+    if config.mode != 'train' and config.device_type == 'cuda':
+        model.half()
+
+    return model
+
+
+
+def prepare_decoder(model, device, batch_sizes):
+    #Dynamo only traces nn.RNN, nn.LSTM and nn.GRU when allow_rnn is set
+    torch._dynamo.config.allow_rnn = True
+    use_cuda = device.type == 'cuda'
+
+    #On GPU each step replays as a captured CUDA graph,
+    #on CPU the compiled step skips the Python dispatch of every module call
+    compiled = torch.compile(
+        model.decoder, 
+        mode='reduce-overhead' if use_cuda else 'default', 
+        fullgraph=True, 
+        dynamic=False
+    )
+
+    def decoder_step(x, hiddens):
+        #Each replay reuses its output memory, so copy the outputs before they feed the next step
+        torch.compiler.cudagraph_mark_step_begin()
+        out, hiddens = compiled(x, hiddens)
+        if isinstance(hiddens, tuple):
+            return out.clone(), tuple(h.clone() for h in hiddens)
+        return out.clone(), hiddens.clone()
+
+    decoder = decoder_step if use_cuda else compiled
+
+    #Compile (and on GPU record) the step for each batch shape the decoding loops use
+    with torch.inference_mode():
+        for batch_size in batch_sizes:
+            x = torch.zeros(batch_size, 1, dtype=torch.long, device=device)
+            for _ in range(2):
+                decoder(x[:, 0], model.encoder(x))
+
+    return decoder
\ No newline at end of file
@@ -1,4 +1,6 @@
 import torch, evaluate
+from .model import prepare_decoder
+from .generate import greedy_decode
 
 
 
@@ -13,10 +15,14 @@ class Tester:
         self.task = config.task
         self.device = config.device
         self.bos_id = config.bos_id
+        self.eos_id = config.eos_id
         self.pad_id = config.pad_id
         self.max_len = config.max_len
+        self.check_steps = 8
         self.vocab_size = config.vocab_size
         self.model_type = config.model_type
+
+        self.decoder = prepare_decoder(model, self.device, [config.batch_size])
         
         self.metric_name = 'BLEU' if self.task == 'translation' else 'ROUGE'
         self.metric_module = evaluate.load(self.metric_name.lower())
@@ -24,45 +30,36 @@ class Tester:
 
 
     def test(self):
-        score = 0.0         
+        preds, labels = [], []
         self.model.eval()
 
-        with torch.no_grad():
+        with torch.inference_mode():
             for batch in self.dataloader:
 
                 x = batch['x'].to(self.device)
-                y = self.tokenize(batch['y'])            
+                labels.extend(self.tokenize(batch['y']))
         
                 pred = self.predict(x)
-                pred = self.tokenize(pred)
+                preds.extend(self.tokenize(pred))
 
-                score += self.evaluate(pred, y)
+        #Corpus level metrics are not averageable across batches
+        score = self.evaluate(preds, labels)
 
         txt = f"TEST Result on {self.task.upper()} with {self.model_type.upper()} model"
-        txt += f"\n-- Score: {round(score/len(self.dataloader), 2)}\n"
+        txt += f"\n-- Score: {round(score, 2)}\n"
         print(txt)
 
 
     def tokenize(self, batch):
-        return [self.tokenizer.decode(x) for x in batch.tolist()]
+        return self.tokenizer.decode_batch(batch.tolist())
 
 
     def predict(self, x):
-        batch_size = x.size(0)
-        
-        pred = torch.LongTensor(batch_size, self.max_len)
-        pred = pred.fill_(self.pad_id).to(self.device)
-        pred[:, 0] = self.bos_id
-
-        pred_token = torch.LongTensor(batch_size).fill_(self.bos_id).to(self.device)
-        hiddens = self.model.encoder(x)
-
-        for t in range(1, self.max_len):
-            out, hiddens = self.model.decoder(pred_token, hiddens)
-            pred_token = out.argmax(-1)
-            pred[:, t] = pred_token
-        
-        return pred
+        return greedy_decode(
+            self.decoder, self.model.encoder, x, 
+            self.bos_id, self.eos_id, self.pad_id, 
+            self.max_len, self.check_steps
+        )
 
 
     def evaluate(self, pred, label):